@@ -1,19 +1,20 @@
 # app.py
-import io
-import os
-import re
-import zipfile
-import tempfile
+import hashlib
 
-import pandas as pd
+import numpy as np
 import streamlit as st
 
-import geopandas as gpd
-from shapely.geometry import Point
-
-import folium
-from folium.plugins import MarkerCluster
-from streamlit_folium import st_folium
+from helpers import (
+    MAX_DECK_POINTS,
+    MAX_PREVIEW_POINTS,
+    build_shapefile_zip,
+    guess_lat_lon_columns,
+    load_points,
+    preview_deck,
+    preview_map,
+    preview_subset,
+    read_csv,
+)
 
 
 # ---------------- Page & UI polish ----------------
@@ -78,120 +79,6 @@ if "show_preview" not in st.session_state:
     st.session_state.show_preview = False
 
 
-# ---------------- Helper functions ----------------
-def normalize_col(s: str) -> str:
-    return re.sub(r"[^a-z0-9]+", "", str(s).strip().lower())
-
-
-LAT_ALIASES = {"lat", "latitude", "y", "ycoord", "ycoordinate"}
-LON_ALIASES = {"lon", "long", "longitude", "x", "xcoord", "xcoordinate"}
-
-
-def guess_lat_lon_columns(df: pd.DataFrame):
-    norm_map = {c: normalize_col(c) for c in df.columns}
-    lat_candidates = [c for c, n in norm_map.items() if n in LAT_ALIASES]
-    lon_candidates = [c for c, n in norm_map.items() if n in LON_ALIASES]
-    lat_col = lat_candidates[0] if lat_candidates else None
-    lon_col = lon_candidates[0] if lon_candidates else None
-    return lat_col, lon_col
-
-
-def safe_shapefile_columns(df: pd.DataFrame) -> pd.DataFrame:
-    """
-    Shapefile constraints:
-      - max 10 characters for column names
-      - avoid duplicates after truncation
-    """
-    new_cols = []
-    used = set()
-    for c in df.columns:
-        base = re.sub(r"[^A-Za-z0-9_]", "_", str(c))[:10]
-        if not base:
-            base = "field"
-        candidate = base
-        i = 1
-        while candidate.lower() in used:
-            suffix = str(i)
-            candidate = (base[: max(0, 10 - len(suffix))] + suffix)[:10]
-            i += 1
-        used.add(candidate.lower())
-        new_cols.append(candidate)
-    out = df.copy()
-    out.columns = new_cols
-    return out
-
-
-def to_download_zip(folder_path: str) -> bytes:
-    mem = io.BytesIO()
-    with zipfile.ZipFile(mem, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for root, _, files in os.walk(folder_path):
-            for f in files:
-                full = os.path.join(root, f)
-                rel = os.path.relpath(full, folder_path)
-                zf.write(full, arcname=rel)
-    mem.seek(0)
-    return mem.read()
-
-
-def build_gdf_from_csv(df: pd.DataFrame, lat_col: str, lon_col: str) -> gpd.GeoDataFrame:
-    work = df.copy()
-    work[lat_col] = pd.to_numeric(work[lat_col], errors="coerce")
-    work[lon_col] = pd.to_numeric(work[lon_col], errors="coerce")
-    work = work.dropna(subset=[lat_col, lon_col])
-
-    gdf = gpd.GeoDataFrame(
-        work,
-        geometry=[Point(xy) for xy in zip(work[lon_col], work[lat_col])],
-        crs="EPSG:4326",  # assumes input is WGS84 lat/lon degrees
-    )
-    return gdf
-
-
-def preview_map(gdf_wgs84: gpd.GeoDataFrame, popup_cols=None):
-    center_lat = float(gdf_wgs84.geometry.y.mean())
-    center_lon = float(gdf_wgs84.geometry.x.mean())
-
-    m = folium.Map(location=[center_lat, center_lon], zoom_start=8, control_scale=True)
-
-    # Safe tiles (avoid attribution errors)
-    folium.TileLayer("OpenStreetMap", name="OpenStreetMap", show=True).add_to(m)
-    folium.TileLayer("CartoDB positron", name="CartoDB Positron", show=False).add_to(m)
-    folium.TileLayer("CartoDB dark_matter", name="CartoDB Dark Matter", show=False).add_to(m)
-
-    cluster = MarkerCluster(name="Points").add_to(m)
-
-    if popup_cols:
-        popup_cols = [c for c in popup_cols if c in gdf_wgs84.columns and c != "geometry"]
-        popup_cols = popup_cols[:6]
-    else:
-        popup_cols = []
-
-    for _, row in gdf_wgs84.iterrows():
-        lat = float(row.geometry.y)
-        lon = float(row.geometry.x)
-
-        popup_html = ""
-        if popup_cols:
-            lines = [f"<b>{c}</b>: {row.get(c, '')}" for c in popup_cols]
-            popup_html = "<br>".join(lines)
-
-        folium.Marker(
-            location=[lat, lon],
-            popup=folium.Popup(popup_html, max_width=320) if popup_html else None,
-            tooltip="Point",
-        ).add_to(cluster)
-
-    # Fit bounds
-    try:
-        minx, miny, maxx, maxy = gdf_wgs84.total_bounds
-        m.fit_bounds([[miny, minx], [maxy, maxx]])
-    except Exception:
-        pass
-
-    folium.LayerControl(collapsed=True).add_to(m)
-    return m
-
-
 # ---------------- Header ----------------
 st.markdown(
     """
@@ -253,11 +140,24 @@ with right:
 
 # ---------------- Processing ----------------
 if uploaded is not None:
-    try:
-        df = pd.read_csv(uploaded, sep=sep, encoding=encoding)
-    except Exception as e:
-        st.error(f"Could not read the CSV. Error: {e}")
-        st.stop()
+    raw = uploaded.getvalue()
+    # Hash each upload once; the caches and the session copies below key on this digest
+    if st.session_state.get("upload_id") != uploaded.file_id:
+        st.session_state.upload_id = uploaded.file_id
+        st.session_state.file_hash = hashlib.sha1(raw).hexdigest()
+    file_hash = st.session_state.file_hash
+
+    # Keep the parsed table on the session so widget reruns reuse it directly
+    # instead of unpickling a fresh copy out of st.cache_data every time
+    table_key = (file_hash, sep, encoding)
+    if st.session_state.get("table_key") != table_key:
+        try:
+            st.session_state.table = read_csv(file_hash, raw, sep=sep, encoding=encoding)
+        except Exception as e:
+            st.error(f"Could not read the CSV. Error: {e}")
+            st.stop()
+        st.session_state.table_key = table_key
+    df = st.session_state.table
 
     with left:
         st.markdown('<div class="section-card">', unsafe_allow_html=True)
@@ -310,14 +210,24 @@ if uploaded is not None:
             epsg = st.text_input("Enter EPSG code (e.g., 4326, 32643, 3857)", value="4326")
             out_crs = f"EPSG:{epsg.strip()}"
 
+        fast_zip = st.checkbox(
+            "Fast (no compression)",
+            value=False,
+            help="Store files in the ZIP uncompressed. Faster for large point sets, larger download.",
+        )
+
         st.markdown("</div>", unsafe_allow_html=True)
 
-    # Build WGS84 GDF for preview + conversion
-    try:
-        gdf_wgs84 = build_gdf_from_csv(df, lat_col, lon_col)
-    except Exception as e:
-        st.error(f"Failed to create points from lat/lon: {e}")
-        st.stop()
+    # Build WGS84 GDF for preview + conversion (reused across Preview/Convert clicks)
+    points_key = (file_hash, sep, encoding, lat_col, lon_col)
+    if st.session_state.get("points_key") != points_key:
+        try:
+            st.session_state.points = load_points(file_hash, raw, sep, encoding, lat_col, lon_col)
+        except Exception as e:
+            st.error(f"Failed to create points from lat/lon: {e}")
+            st.stop()
+        st.session_state.points_key = points_key
+    gdf_wgs84 = st.session_state.points
 
     if len(gdf_wgs84) == 0:
         st.error("No valid rows after cleaning lat/lon (missing or non-numeric).")
@@ -344,57 +254,55 @@ if uploaded is not None:
         st.markdown('<div class="section-card">', unsafe_allow_html=True)
         st.subheader("7) Map Preview")
 
-        bad = gdf_wgs84[
-            (gdf_wgs84.geometry.y.abs() > 90) |
-            (gdf_wgs84.geometry.x.abs() > 180)
-        ]
-        if len(bad) > 0:
+        # Coerced coordinate columns; only needed while the preview is shown
+        lat_arr = gdf_wgs84[lat_col].to_numpy(dtype="float64")
+        lon_arr = gdf_wgs84[lon_col].to_numpy(dtype="float64")
+        n_bad = int(((np.abs(lat_arr) > 90) | (np.abs(lon_arr) > 180)).sum())
+        if n_bad > 0:
             st.warning(
-                f"{len(bad)} points look out-of-range for WGS84 degrees (lat ±90, lon ±180). "
+                f"{n_bad} points look out-of-range for WGS84 degrees (lat ±90, lon ±180). "
                 "If your coordinates are projected (meters), the preview will look wrong."
             )
 
-        m = preview_map(gdf_wgs84, popup_cols=popup_cols)
-        st_folium(m, width=1200, height=560)
+        if len(gdf_wgs84) > MAX_PREVIEW_POINTS:
+            # Thinning is O(N log N); keep the result until the points themselves change
+            if st.session_state.get("preview_points_key") != points_key:
+                st.session_state.preview_points = preview_subset(gdf_wgs84, MAX_DECK_POINTS)
+                st.session_state.preview_points_key = points_key
+            points = st.session_state.preview_points
+            if len(points) < len(gdf_wgs84):
+                st.caption(
+                    f"Preview is a spatially thinned sample: {len(points):,} of "
+                    f"{len(gdf_wgs84):,} points. The shapefile contains every point."
+                )
+            st.caption(
+                "Large layer: drawn as a WebGL scatter. "
+                f"Popups are available for files with up to {MAX_PREVIEW_POINTS:,} points."
+            )
+            st.pydeck_chart(preview_deck(points, gdf_wgs84.total_bounds), use_container_width=True)
+        else:
+            from streamlit_folium import st_folium
+
+            m = preview_map(gdf_wgs84, popup_cols=popup_cols)
+            st_folium(m, width=1200, height=560)
         st.markdown("</div>", unsafe_allow_html=True)
 
     # Conversion
     if convert_btn:
         st.markdown('<div class="section-card">', unsafe_allow_html=True)
         st.subheader("8) Download")
-        gdf_out = gdf_wgs84.copy()
-
         try:
-            if out_crs != "EPSG:4326":
-                gdf_out = gdf_out.to_crs(out_crs)
-        except Exception as e:
-            st.error(f"CRS reprojection failed: {e}")
+            zip_buf = build_shapefile_zip(
+                file_hash, raw, sep, encoding, lat_col, lon_col, out_crs, not fast_zip
+            )
+        except RuntimeError as e:
+            st.error(str(e))
             st.stop()
 
-        attrs = gdf_out.drop(columns="geometry")
-        attrs_safe = safe_shapefile_columns(attrs)
-        gdf_safe = gpd.GeoDataFrame(attrs_safe, geometry=gdf_out.geometry, crs=gdf_out.crs)
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            out_name = "points_from_csv"
-            shp_path = os.path.join(tmpdir, f"{out_name}.shp")
-
-            try:
-                gdf_safe.to_file(shp_path, driver="ESRI Shapefile")
-            except Exception as e:
-                st.error(
-                    "Failed to write shapefile. Install a working GeoPandas I/O backend "
-                    "(`pyogrio` recommended; or `fiona`).\n\n"
-                    f"Error: {e}"
-                )
-                st.stop()
-
-            zip_bytes = to_download_zip(tmpdir)
-
-        st.success(f"✅ Created shapefile with {len(gdf_safe)} points.")
+        st.success(f"✅ Created shapefile with {len(gdf_wgs84)} points.")
         st.download_button(
             "⬇️ Download Shapefile (ZIP)",
-            data=zip_bytes,
+            data=zip_buf,
             file_name="shapefile_from_csv.zip",
             mime="application/zip",
             use_container_width=True,
@@ -0,0 +1 @@
+# Lets the tests import app-level modules such as helpers.py from the repo root.
@@ -0,0 +1,442 @@
+# helpers.py
+from __future__ import annotations
+
+import functools
+import io
+import os
+import re
+import zipfile
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import streamlit as st
+
+# The geospatial and mapping stacks take seconds to import; they are imported
+# inside the functions that need them so the upload page paints first
+if TYPE_CHECKING:
+    import geopandas as gpd
+    import pydeck as pdk
+    from pyproj import Transformer
+
+
+# Copy-on-write: column drops, slices and relabelled frames share data until
+# something is written to them (always on from pandas 3.0)
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.options.mode.copy_on_write = True
+
+
+# Every byte except [a-z0-9]; used with bytes.translate to strip them in one C pass
+_NON_ALNUM = bytes(b for b in range(256) if b not in b"abcdefghijklmnopqrstuvwxyz0123456789")
+
+
+# Pure function of the header text; widget reruns keep asking for the same names
+@functools.lru_cache(maxsize=4096)
+def normalize_col(s: str) -> str:
+    # Non-ASCII characters can never survive, so drop them at encode time
+    return str(s).lower().encode("ascii", "ignore").translate(None, _NON_ALNUM).decode("ascii")
+
+
+LAT_ALIASES = frozenset({"lat", "latitude", "y", "ycoord", "ycoordinate"})
+LON_ALIASES = frozenset({"lon", "long", "longitude", "x", "xcoord", "xcoordinate"})
+
+
+def guess_lat_lon_columns(df: pd.DataFrame):
+    lat_col = lon_col = None
+    for c in df.columns:
+        n = normalize_col(c)
+        if lat_col is None and n in LAT_ALIASES:
+            lat_col = c
+        elif lon_col is None and n in LON_ALIASES:
+            lon_col = c
+        if lat_col is not None and lon_col is not None:
+            break
+    return lat_col, lon_col
+
+
+CSV_CHUNKSIZE = 250_000
+CSV_CHUNKS_IN_FLIGHT = 2
+ARROW_STRING_TYPES = {
+    pa.string(): pd.StringDtype("pyarrow"),
+    pa.large_string(): pd.StringDtype("pyarrow"),
+}
+
+
+def is_temporal_type(t: pa.DataType) -> bool:
+    return pa.types.is_timestamp(t) or pa.types.is_date(t) or pa.types.is_time(t)
+
+
+def arrow_string_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Store text columns as Arrow strings instead of one Python object per cell.
+    Numeric columns keep their NumPy dtypes so pyogrio still maps them to
+    numeric DBF fields.
+    """
+    obj_cols = df.select_dtypes(include="object").columns
+    if len(obj_cols) == 0:
+        return df
+    return df.astype({c: "string[pyarrow]" for c in obj_cols})
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def read_csv(file_hash: str, _raw: bytes, sep: str, encoding: str) -> pd.DataFrame:
+    """
+    Parse UTF-8 input with Arrow's multi-threaded CSV reader; use pandas (in
+    fixed-size row chunks) for other encodings and anything Arrow rejects.
+
+    Cached on the upload's digest so widget-driven reruns skip the parse. The
+    underscore on ``_raw`` keeps Streamlit from re-hashing the whole file.
+    """
+    # Arrow reads UTF-8 bytes as-is (skipping a BOM); any other encoding would
+    # first be transcoded through a Python codec, which loses its advantage
+    if encoding in ("utf-8", "utf-8-sig"):
+        try:
+            parse_options = pacsv.ParseOptions(delimiter=sep)
+            # Arrow infers timestamp/date/time columns where pandas keeps the text;
+            # those are read as strings so the written values don't depend on the
+            # reader (a DBF Date field would drop the time of day). Opening the
+            # stream only parses the first block, which is all inference looks at.
+            schema = pacsv.open_csv(io.BytesIO(_raw), parse_options=parse_options).schema
+            temporal = {f.name: pa.string() for f in schema if is_temporal_type(f.type)}
+            # Empty cells and NA/NULL markers become nulls, as they do under pandas
+            convert_options = pacsv.ConvertOptions(column_types=temporal, strings_can_be_null=True)
+            tbl = pacsv.read_csv(
+                io.BytesIO(_raw), parse_options=parse_options, convert_options=convert_options
+            )
+            # Text that isn't valid UTF-8 is inferred as binary rather than
+            # rejected; pandas raises UnicodeDecodeError for it instead
+            has_binary = any(
+                pa.types.is_binary(f.type) or pa.types.is_large_binary(f.type) for f in tbl.schema
+            )
+            # pandas de-duplicates repeated headers; Arrow keeps them as-is
+            if not has_binary and len(set(tbl.column_names)) == len(tbl.column_names):
+                # Text columns stay in their Arrow buffers instead of round-tripping through objects
+                return tbl.to_pandas(types_mapper=ARROW_STRING_TYPES.get)
+        except pa.ArrowInvalid:
+            pass
+
+    chunks = pd.read_csv(io.BytesIO(_raw), sep=sep, encoding=encoding, chunksize=CSV_CHUNKSIZE)
+    # Convert each parsed chunk on a worker thread while the next one is being
+    # parsed; at most a few converted-but-uncollected chunks are kept in flight
+    frames = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        for chunk in chunks:
+            pending.append(pool.submit(arrow_string_columns, chunk))
+            if len(pending) > CSV_CHUNKS_IN_FLIGHT:
+                frames.append(pending.popleft().result())
+        frames.extend(f.result() for f in pending)
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
+
+_SAFE_RE = re.compile(r"[^A-Za-z0-9_]")
+
+
+def safe_shapefile_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Shapefile constraints:
+      - max 10 characters for column names
+      - avoid duplicates after truncation
+    """
+    new_cols = []
+    used = set()
+    next_suffix = {}  # base.lower() -> first suffix not yet tried for that base
+    for c in df.columns:
+        base = _SAFE_RE.sub("_", str(c))[:10]
+        if not base:
+            base = "field"
+        key = base.lower()
+        candidate = base
+        i = next_suffix.get(key, 1)
+        while candidate.lower() in used:
+            suffix = str(i)
+            candidate = (base[: max(0, 10 - len(suffix))] + suffix)[:10]
+            i += 1
+        next_suffix[key] = i
+        used.add(candidate.lower())
+        new_cols.append(candidate)
+    # Only the labels change; under copy-on-write the data is shared
+    return df.set_axis(new_cols, axis=1)
+
+
+def downcast_integer_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Shrink integer attribute columns to the smallest signed type that holds
+    their values, so GDAL writes narrower DBF fields (int64 becomes an
+    18-digit Integer64 field). Floats are left alone to keep their precision.
+    """
+    int_cols = df.select_dtypes(include="integer").columns
+    if len(int_cols) == 0:
+        return df
+    return df.assign(**{c: pd.to_numeric(df[c], downcast="integer") for c in int_cols})
+
+
+# Attribute/text sidecars that deflate well; .shp/.shx are packed doubles and
+# offsets that barely shrink, so they are stored as-is
+DEFLATE_EXTENSIONS = frozenset({".dbf", ".prj", ".cpg"})
+
+
+def to_download_zip(folder_path: str, compress: bool = True) -> io.BytesIO:
+    mem = io.BytesIO()
+    with zipfile.ZipFile(mem, mode="w", compression=zipfile.ZIP_STORED) as zf:
+        # GDAL writes the shapefile sidecars flat into the folder; scandir
+        # reuses the directory entries instead of walking and re-stat'ing paths
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                ext = os.path.splitext(entry.name)[1].lower()
+                if compress and ext in DEFLATE_EXTENSIONS:
+                    # Level 1: close to the default level's ratio at a fraction of the CPU
+                    zf.write(
+                        entry.path,
+                        arcname=entry.name,
+                        compress_type=zipfile.ZIP_DEFLATED,
+                        compresslevel=1,
+                    )
+                else:
+                    zf.write(entry.path, arcname=entry.name)
+    # Hand the buffer itself to st.download_button rather than copying it out
+    mem.seek(0)
+    return mem
+
+
+def build_gdf_from_csv(df: pd.DataFrame, lat_col: str, lon_col: str) -> gpd.GeoDataFrame:
+    import geopandas as gpd
+    import shapely
+
+    # Coerce only the two coordinate columns; the attribute columns are sliced
+    # once by the validity mask instead of being copied up front
+    lat_num = pd.to_numeric(df[lat_col], errors="coerce")
+    lon_num = pd.to_numeric(df[lon_col], errors="coerce")
+    mask = lat_num.notna() & lon_num.notna()
+    work = df.loc[mask].assign(**{lat_col: lat_num[mask], lon_col: lon_num[mask]})
+
+    # One vectorized call into GEOS instead of a Point() per row
+    lon = work[lon_col].to_numpy(dtype="float64", copy=False)
+    lat = work[lat_col].to_numpy(dtype="float64", copy=False)
+    gdf = gpd.GeoDataFrame(
+        work,
+        geometry=shapely.points(lon, lat),
+        crs="EPSG:4326",  # assumes input is WGS84 lat/lon degrees
+    )
+    return gdf
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_points(
+    file_hash: str, _raw: bytes, sep: str, encoding: str, lat_col: str, lon_col: str
+) -> gpd.GeoDataFrame:
+    # Keyed on the upload digest rather than the DataFrame, which is costly to hash
+    return build_gdf_from_csv(read_csv(file_hash, _raw, sep, encoding), lat_col, lon_col)
+
+
+@functools.lru_cache(maxsize=16)
+def wgs84_transformer(out_crs: str) -> Transformer:
+    from pyproj import Transformer
+
+    # Building a PROJ pipeline costs far more than a small point transform;
+    # reuse it across conversions to the same CRS
+    return Transformer.from_crs("EPSG:4326", out_crs, always_xy=True)
+
+
+SHAPEFILE_WRITE_BATCH = 500_000
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def build_shapefile_zip(
+    file_hash: str,
+    _raw: bytes,
+    sep: str,
+    encoding: str,
+    lat_col: str,
+    lon_col: str,
+    out_crs: str,
+    compress: bool,
+) -> io.BytesIO:
+    """
+    Full CSV -> zipped shapefile conversion, cached so repeat clicks with the
+    same inputs skip reprojection and the shapefile write.
+    """
+    import geopandas as gpd
+    import shapely
+
+    gdf_wgs84 = load_points(file_hash, _raw, sep, encoding, lat_col, lon_col)
+    attrs_safe = downcast_integer_columns(safe_shapefile_columns(gdf_wgs84.drop(columns="geometry")))
+
+    tf = None
+    if out_crs != "EPSG:4326":
+        # Transform the coerced coordinate arrays with vectorized PROJ calls and
+        # build the points directly, instead of round-tripping through GeoSeries.to_crs
+        try:
+            tf = wgs84_transformer(out_crs)
+        except Exception as e:
+            raise RuntimeError(f"CRS reprojection failed: {e}") from e
+        lon = gdf_wgs84[lon_col].to_numpy(dtype="float64")
+        lat = gdf_wgs84[lat_col].to_numpy(dtype="float64")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        out_name = "points_from_csv"
+        shp_path = os.path.join(tmpdir, f"{out_name}.shp")
+
+        # Large layers are reprojected and appended in row batches, so only one
+        # batch of new geometries (and its serialized form) is alive at a time
+        for start in range(0, len(attrs_safe), SHAPEFILE_WRITE_BATCH):
+            stop = start + SHAPEFILE_WRITE_BATCH
+            geometry, crs = gdf_wgs84.geometry.values[start:stop], gdf_wgs84.crs
+            if tf is not None:
+                try:
+                    x, y = tf.transform(lon[start:stop], lat[start:stop])
+                except Exception as e:
+                    raise RuntimeError(f"CRS reprojection failed: {e}") from e
+                geometry, crs = shapely.points(x, y), out_crs
+            batch = gpd.GeoDataFrame(attrs_safe.iloc[start:stop], geometry=geometry, crs=crs)
+
+            try:
+                try:
+                    # pyogrio hands whole columns to GDAL instead of one feature at a time
+                    batch.to_file(
+                        shp_path, driver="ESRI Shapefile", engine="pyogrio", mode="a" if start else "w"
+                    )
+                except ImportError:
+                    batch.to_file(
+                        shp_path, driver="ESRI Shapefile", engine="fiona", mode="a" if start else "w"
+                    )
+            except Exception as e:
+                raise RuntimeError(
+                    "Failed to write shapefile. Install a working GeoPandas I/O backend "
+                    "(`pyogrio` recommended; or `fiona`).\n\n"
+                    f"Error: {e}"
+                ) from e
+
+        return to_download_zip(tmpdir, compress=compress)
+
+
+# Above this many points the preview switches from Leaflet markers to a deck.gl scatter
+MAX_PREVIEW_POINTS = 5000
+# deck.gl draws on the GPU, but every point still travels over the websocket as JSON
+MAX_DECK_POINTS = 200_000
+
+
+# Grid cell size (degrees, ~1 km) used to thin dense areas of large previews
+PREVIEW_GRID_DEG = 0.01
+
+
+def preview_subset(gdf_wgs84: gpd.GeoDataFrame, max_points: int) -> gpd.GeoDataFrame:
+    if len(gdf_wgs84) <= max_points:
+        return gdf_wgs84
+    # Keep the first point in each grid cell so dense clusters are thinned while
+    # sparse outliers survive, then space the survivors evenly if still too many.
+    # Deterministic, so reruns show the same preview.
+    x = gdf_wgs84.geometry.values.x
+    y = gdf_wgs84.geometry.values.y
+    # Non-finite coordinates can't be drawn (or binned), so they are left out
+    pos = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if len(pos) == 0:
+        return gdf_wgs84.iloc[:0]
+    ix = np.floor(x[pos] / PREVIEW_GRID_DEG).astype(np.int64)
+    iy = np.floor(y[pos] / PREVIEW_GRID_DEG).astype(np.int64)
+    # One int64 key per cell: np.unique on a 1-D key is far cheaper than on N x 2 rows
+    key = (ix - ix.min()) * (np.ptp(iy) + 1) + (iy - iy.min())
+    _, first = np.unique(key, return_index=True)
+    idx = np.sort(pos[first])
+    if len(idx) > max_points:
+        idx = idx[np.linspace(0, len(idx) - 1, max_points).astype(int)]
+    return gdf_wgs84.iloc[idx]
+
+
+def preview_deck(points: gpd.GeoDataFrame, bounds) -> pdk.Deck:
+    import pydeck as pdk
+
+    # `bounds` comes from the full layer so the view is the same however it was thinned
+    data = pd.DataFrame({"lat": points.geometry.values.y, "lon": points.geometry.values.x})
+
+    minx, miny, maxx, maxy = bounds
+    layer = pdk.Layer(
+        "ScatterplotLayer",
+        data=data,
+        get_position="[lon, lat]",
+        get_radius=50,
+        radius_min_pixels=2,
+        get_fill_color=[220, 60, 60, 160],
+        pickable=True,
+    )
+    view = pdk.ViewState(latitude=float((miny + maxy) / 2), longitude=float((minx + maxx) / 2), zoom=6)
+    return pdk.Deck(layers=[layer], initial_view_state=view, tooltip={"text": "{lat}, {lon}"})
+
+
+# Leaflet marker factory for FastMarkerCluster rows of [lat, lon] or [lat, lon, popup_html]
+MARKER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    if (row.length > 2) {
+        marker.bindPopup(row[2], {maxWidth: 320});
+    }
+    marker.bindTooltip("Point");
+    return marker;
+}
+"""
+
+
+def preview_map(gdf_wgs84: gpd.GeoDataFrame, popup_cols=None):
+    import folium
+    from folium.plugins import FastMarkerCluster
+
+    # Read the point coordinates once as flat float arrays; bounds, center and
+    # the marker data all come from them. Callers only pass layers within
+    # MAX_PREVIEW_POINTS, so every point gets a marker.
+    xs = gdf_wgs84.geometry.values.x
+    ys = gdf_wgs84.geometry.values.y
+    has_points = len(xs) > 0
+    if has_points:
+        minx, maxx, miny, maxy = xs.min(), xs.max(), ys.min(), ys.max()
+        center_lat = float((miny + maxy) / 2)
+        center_lon = float((minx + maxx) / 2)
+    else:
+        center_lat = center_lon = 0.0
+
+    m = folium.Map(location=[center_lat, center_lon], zoom_start=8, control_scale=True)
+
+    # Safe tiles (avoid attribution errors)
+    folium.TileLayer("OpenStreetMap", name="OpenStreetMap", show=True).add_to(m)
+    folium.TileLayer("CartoDB positron", name="CartoDB Positron", show=False).add_to(m)
+    folium.TileLayer("CartoDB dark_matter", name="CartoDB Dark Matter", show=False).add_to(m)
+
+    if popup_cols:
+        popup_cols = [c for c in popup_cols if c in gdf_wgs84.columns and c != "geometry"]
+        popup_cols = popup_cols[:6]
+    else:
+        popup_cols = []
+
+    lats, lons = ys, xs
+    if popup_cols:
+        # Build every popup column-wise with vectorized string concatenation.
+        # Object Series grow with each cell's own length; fixed-width NumPy
+        # strings would pad every row to the longest cell.
+        popup_html = None
+        for c in popup_cols:
+            # Via object so missing Arrow-string cells render as text, not NA
+            piece = f"<b>{c}</b>: " + gdf_wgs84[c].astype(object).astype(str)
+            popup_html = piece if popup_html is None else popup_html + "<br>" + piece
+        data = [list(row) for row in zip(lats.tolist(), lons.tolist(), popup_html.tolist())]
+    else:
+        data = np.column_stack([lats, lons]).tolist()
+
+    # One array shipped to the browser; the callback builds each marker client-side
+    FastMarkerCluster(data, callback=MARKER_CALLBACK, name="Points").add_to(m)
+
+    # Fit bounds
+    if has_points:
+        m.fit_bounds([[miny, minx], [maxy, maxx]])
+
+    folium.LayerControl(collapsed=True).add_to(m)
+    return m
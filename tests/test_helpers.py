@@ -0,0 +1,56 @@
+import zipfile
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+pytest.importorskip("streamlit")
+
+import helpers  # noqa: E402
+from helpers import build_shapefile_zip, read_csv  # noqa: E402
+
+
+@pytest.mark.parametrize("encoding", ["utf-8", "latin1"])
+def test_read_csv_keeps_datetime_text(encoding):
+    raw = b"name,lat,lon,when\nA,30.284,77.985,2024-01-02 10:11:12\nB,30.290,77.990,2024-01-03\n"
+    df = read_csv(f"datetime-{encoding}", raw, ",", encoding)
+    assert not pd.api.types.is_datetime64_any_dtype(df["when"])
+    assert df["when"].tolist() == ["2024-01-02 10:11:12", "2024-01-03"]
+
+
+@pytest.mark.parametrize("encoding", ["utf-8", "latin1"])
+def test_read_csv_empty_and_na_text_is_null(encoding):
+    raw = b"name,lat,lon,note\nA,30.284,77.985,\nB,30.290,77.990,NA\nC,30.300,78.000,ok\n"
+    df = read_csv(f"nulls-{encoding}", raw, ",", encoding)
+    assert df["note"].isna().tolist() == [True, True, False]
+
+
+def test_read_csv_rejects_non_utf8_text_under_utf8():
+    raw = "name,lat,lon\nMontréal,45.50,-73.57\n".encode("latin1")
+    with pytest.raises(UnicodeDecodeError):
+        read_csv("latin1-as-utf8", raw, ",", "utf-8")
+
+
+def test_build_shapefile_zip_appends_reprojected_batches(monkeypatch, tmp_path):
+    pyogrio = pytest.importorskip("pyogrio")
+    pytest.importorskip("geopandas")
+    from pyproj import Transformer
+
+    monkeypatch.setattr(helpers, "SHAPEFILE_WRITE_BATCH", 2)
+    lats = [30.1, 30.2, 30.3, 30.4, 30.5]
+    lons = [77.1, 77.2, 77.3, 77.4, 77.5]
+    rows = "".join(f"P{i},{lat},{lon},{i * 10}\n" for i, (lat, lon) in enumerate(zip(lats, lons)))
+    raw = ("name,lat,lon,value\n" + rows).encode("utf-8")
+
+    buf = build_shapefile_zip("batched-3857", raw, ",", "utf-8", "lat", "lon", "EPSG:3857", True)
+    with zipfile.ZipFile(buf) as zf:
+        zf.extractall(tmp_path)
+    out = pyogrio.read_dataframe(tmp_path / "points_from_csv.shp")
+
+    assert len(out) == 5
+    assert list(out.columns) == ["name", "lat", "lon", "value", "geometry"]
+    assert out["name"].tolist() == [f"P{i}" for i in range(5)]
+    assert out.crs.to_epsg() == 3857
+    x, y = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True).transform(lons, lats)
+    assert out.geometry.x.tolist() == pytest.approx(list(x))
+    assert out.geometry.y.tolist() == pytest.approx(list(y))